@@ -1,15 +1,20 @@
 import argparse
 import os
+import sys
 from pathlib import Path
 
-import rich.traceback
-
-from llmo.gui import LLMO
 from llmo.constants import MODELS, DEFAULT_MAX_TOKENS
-from llmo.llms import OpenAI
-from llmo.shell_mode import run_shell_mode
 
-rich.traceback.install()
+
+def _rich_excepthook(exc_type, exc_value, traceback):
+    """Install rich tracebacks on the first uncaught exception, rather than importing rich on every run."""
+    import rich.traceback
+
+    rich.traceback.install()
+    sys.excepthook(exc_type, exc_value, traceback)
+
+
+sys.excepthook = _rich_excepthook
 
 
 def main():
@@ -53,6 +58,12 @@ def main():
         action="store_false",
         help="disable personality. can also be set with LLMO_DISABLE_PERSONALITY env var",
     )
+    parser.add_argument(
+        "--no-cache",
+        dest="enable_cache",
+        action="store_false",
+        help="always query the API, even for requests identical to earlier ones",
+    )
     parser.add_argument(
         "-t",
         "--max-tokens",
@@ -88,26 +99,36 @@ def main():
     staged_files = [Path(f) for f in args.files] if args.files else []
 
     for f in staged_files:
-        assert f.exists(), f"File {f} does not exist"
+        try:
+            f.stat()
+        except OSError as e:
+            parser.error(f"cannot read file {f}: {e.strerror}")
+
+    # imported here so --help and argument errors don't pay for the openai and textual imports
+    from llmo.llms import OpenAI
 
     openai_client = OpenAI(
         model=args.model,
         api_key=args.key,
         max_tokens=args.max_tokens,
+        enable_cache=args.enable_cache,
     )
 
     if args.personality:
         openai_client.add_personality()
 
     if args.shell_mode:
-        files = [Path(f) for f in args.files] if args.files else []
+        from llmo.shell_mode import run_shell_mode
+
         run_shell_mode(
             openai_client,
             prompt=args.prompt,
-            files=files,
+            files=staged_files,
             rich_text_mode=args.rich_text_mode,
         )
     else:
+        from llmo.gui import LLMO
+
         app = LLMO(
             prompt=args.prompt,
             staged_files=staged_files,
@@ -1,5 +1,13 @@
 DEFAULT_MAX_TOKENS = 4097
-ESTIMATED_CHAR_PER_TOKEN = 4.68
+# ~4.68 characters per token, kept as an integer ratio so estimates avoid float math
+ESTIMATED_CHARS_PER_100_TOKENS = 468
+# seconds between re-renders of streamed markdown in the GUI
+MARKDOWN_UPDATE_INTERVAL = 0.08
+# number of assistant responses kept for repeated prompts
+RESPONSE_CACHE_SIZE = 128
+# staged files modified this close to being read aren't trusted from the cache, since a
+# same-size rewrite within the filesystem's mtime granularity wouldn't change the mtime
+FILE_CACHE_RACY_WINDOW_NS = 2_000_000_000
 MODELS = [
     "gpt-3.5-turbo",
     "gpt-4",
@@ -1,8 +1,7 @@
-import asyncio
+import time
 from pathlib import Path
 from typing import Iterable, Protocol
 
-import openai
 from textual import work, on
 from textual.app import App, ComposeResult
 from textual.containers import Horizontal, Vertical, Container, VerticalScroll
@@ -22,8 +21,7 @@ from textual.widgets import (
     Select, Switch,
 )
 
-from llmo.constants import MODELS
-from llmo.llms import OpenAI
+from llmo.constants import MODELS, MARKDOWN_UPDATE_INTERVAL
 
 
 class LLMInterface(Protocol):
@@ -38,6 +36,12 @@ class LLMInterface(Protocol):
     async def asubmit(self, prompt: str, files: Iterable[Path] = None):
         ...
 
+    async def submit_async(self, prompt: str, files: Iterable[Path] = None) -> str:
+        ...
+
+    async def aclose(self) -> None:
+        ...
+
     def add_personality(self) -> None:
         ...
 
@@ -65,20 +69,39 @@ class LLMO(App):
         **kwargs,
     ):
         super().__init__(**kwargs)
-        self.staged_files = set(staged_files) if staged_files else set()
+        # a dict rather than a set so staged files keep the order they were added in
+        self.staged_files: dict[Path, None] = dict.fromkeys(staged_files or ())
         self.prompt = prompt
         self.current_tab = current_tab
-        self.llm_client = llm_client or OpenAI()
+        if llm_client is None:
+            # only pull in the openai SDK when no client was provided
+            from llmo.llms import OpenAI
+
+            llm_client = OpenAI()
+        self.llm_client = llm_client
         self.selected_file = None
         self.rich_text_mode = rich_text_mode
         self.markdown = ""
+        self._button_handlers = {
+            "stage-file-button": self.action_stage_file,
+            "reset-stage-button": self.action_reset_stage,
+        }
 
     def on_mount(self):
-        input_widget = self.query_one("#prompt", Input)
-        input_widget.focus()
+        # look up the widgets used by event handlers once, instead of querying the DOM on every event
+        self._prompt_input = self.query_one("#prompt", Input)
+        self._response_view = self.query_one("#response")
+        self._scroll_area = self.query_one("#scroll-area", VerticalScroll)
+        self._staged_files_view = self.query_one("#staged-files", ListView)
+        self._stage_file_button = self.query_one("#stage-file-button", Button)
+        self._content_switcher = self.query_one(ContentSwitcher)
+        self._prompt_input.focus()
         if self.prompt:
             self.handle_initial_submission()
 
+    async def on_unmount(self):
+        await self.llm_client.aclose()
+
     def compose(self) -> ComposeResult:
         if not self.rich_text_mode:
             response_view = TextLog(
@@ -167,11 +190,10 @@ class LLMO(App):
 
     def update_stage_file_button_variant(self):
         selected_file = self.selected_file
-        stage_file_button = self.query_one("#stage-file-button", Button)
         if selected_file and selected_file not in self.staged_files:
-            stage_file_button.variant = "success"
+            self._stage_file_button.variant = "success"
         else:
-            stage_file_button.variant = "default"
+            self._stage_file_button.variant = "default"
 
     def on_directory_tree_file_selected(self, event: DirectoryTree.FileSelected):
         self.selected_file = Path(event.path)
@@ -181,44 +203,34 @@ class LLMO(App):
         self.set_tab("chat" if self.current_tab == "context" else "context")
 
     def action_stage_file(self):
-        if self.selected_file:
-            self.staged_files.add(self.selected_file)
-            staged_files_view = self.query_one("#staged-files", ListView)
-            staged_files_view.clear()
-            for f in self.staged_files:
-                staged_files_view.append(ListItem(Label(str(f))))
+        if self.selected_file and self.selected_file not in self.staged_files:
+            self.staged_files[self.selected_file] = None
+            self._staged_files_view.append(ListItem(Label(str(self.selected_file))))
             self.update_stage_file_button_variant()
 
     def action_reset_stage(self):
         self.staged_files.clear()
-        self.query_one("#staged-files", ListView).clear()
+        self._staged_files_view.clear()
 
     def on_button_pressed(self, event: Button.Pressed):
         if event.button.id.endswith("-choice-button"):
             id_ = event.button.id.split("-")[0]
             self.set_tab(id_)
-
-        if event.button.id == "stage-file-button":
-            self.action_stage_file()
-
-        elif event.button.id == "reset-stage-button":
-            self.action_reset_stage()
-
-        if event.button.id == "submit-prompt-button":
-            self.action_submit()
+        elif handler := self._button_handlers.get(event.button.id):
+            handler()
 
     def set_tab(self, id_):
         self.current_tab = id_
-        self.query_one(ContentSwitcher).current = self.current_tab
+        self._content_switcher.current = self.current_tab
         if self.current_tab == "chat":
-            self.query_one("#prompt", Input).focus()
+            self._prompt_input.focus()
 
     def action_reset_all(self):
         self.action_reset_chat()
         self.action_reset_stage()
 
     def action_reset_chat(self):
-        response_view = self.query_one("#response")  # noqa
+        response_view = self._response_view  # noqa
         if self.rich_text_mode:
             response_view: Markdown
             self.markdown = ""
@@ -228,14 +240,14 @@ class LLMO(App):
             self.llm_client.reset()
             response_view.clear()
         # clear prompt
-        self.query_one("#prompt", Input).value = ""
+        self._prompt_input.value = ""
 
     def on_input_changed(self, event: Input.Changed):
         if event.input.id == "prompt":
             self.prompt = event.input.value
         elif event.input.id == "api-key-input":
+            # the client sends its own key with each request, so there's no global to update
             self.llm_client.api_key = event.input.value
-            openai.api_key = self.llm_client.api_key
         else:
             raise ValueError(f"Unknown input: {event.input.id}")
 
@@ -243,41 +255,43 @@ class LLMO(App):
         await self.handle_submission()
 
     async def handle_submission(self):
-        prompt_area = self.query_one("#prompt")
         loading_indicator = LoadingIndicator()
-        await prompt_area.mount(loading_indicator)
+        await self._prompt_input.mount(loading_indicator)
 
         if not self.rich_text_mode:
-            response = await asyncio.get_event_loop().run_in_executor(
-                None,
-                self.llm_client.submit,
+            response = await self.llm_client.submit_async(
                 self.prompt,
                 self.staged_files,
             )
-            log = self.query_one("#response", TextLog)
+            log: TextLog = self._response_view
             log.write(f">> {self.prompt}\n")
             log.write(response)
             log.write("\n\n")
         else:
-            scroll_area = self.query_one("#scroll-area")
-            output = self.query_one("#response", Markdown)
+            scroll_area = self._scroll_area
+            output: Markdown = self._response_view
             self.markdown += f"{self.prompt}"
             output.update(self.markdown)
             self.markdown += "\n---\n"
+            # re-rendering parses the whole document, so only flush on newlines or every so often
+            last_update = time.monotonic()
             async for content in self.llm_client.asubmit(
                 prompt=self.prompt,
                 files=self.staged_files,
             ):
                 self.markdown += content
-                output.update(self.markdown)
-                output.scroll_page_down()
-                scroll_area.scroll_page_down()
+                now = time.monotonic()
+                if "\n" in content or now - last_update >= MARKDOWN_UPDATE_INTERVAL:
+                    last_update = now
+                    output.update(self.markdown)
+                    output.scroll_page_down()
+                    scroll_area.scroll_page_down()
             self.markdown += "\n---\n"
             output.update(self.markdown)
             output.scroll_page_down()
             scroll_area.scroll_page_down()
 
-        self.query_one("#prompt", Input).value = ""
+        self._prompt_input.value = ""
         await loading_indicator.remove()
 
     @work
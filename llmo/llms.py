@@ -1,15 +1,23 @@
 import asyncio
-from collections import deque
-from copy import copy
+import hashlib
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
+from functools import lru_cache
 from pathlib import Path
 from typing import TypedDict, Literal, Iterable
 
+import aiohttp
 import openai
 import openai.error
 from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type
 
-from llmo.constants import ESTIMATED_CHAR_PER_TOKEN
+from llmo.constants import (
+    ESTIMATED_CHARS_PER_100_TOKENS,
+    FILE_CACHE_RACY_WINDOW_NS,
+    RESPONSE_CACHE_SIZE,
+)
 
 
 class Message(TypedDict):
@@ -22,6 +30,37 @@ class SystemMessage(TypedDict):
     content: str
 
 
+@lru_cache(maxsize=1)
+def _get_encoding():
+    """
+    Return the tiktoken encoding used by the chat models.
+
+    Returns None if tiktoken isn't installed or its encoding can't be loaded,
+    e.g. when the BPE file can't be downloaded offline.
+    """
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception:
+        return None
+
+
+def estimate_tokens(content: str) -> int:
+    """Count tokens with tiktoken if it's available, otherwise estimate them from the character count."""
+    if encoding := _get_encoding():
+        # staged files can legitimately contain special tokens like <|endoftext|>,
+        # which encode() refuses by default
+        return len(encoding.encode_ordinary(content))
+    return len(content) * 100 // ESTIMATED_CHARS_PER_100_TOKENS
+
+
+def _hash_message(role: str, content: str) -> bytes:
+    return hashlib.blake2b(f"{role}\0{content}".encode(), digest_size=16).digest()
+
+
 def retry_openai_call(func):
     return retry(
         retry=(
@@ -38,7 +77,9 @@ def retry_openai_call(func):
 class OpenAI:
     model: str = "gpt-3.5-turbo"
     temperature: float = 0.7
-    messages: deque[Message] = field(default_factory=deque)
+    # the conversation so far. replace it by assignment rather than editing it in place:
+    # in-place edits are only noticed on the next submit if they change its length
+    messages: list[Message] = field(default_factory=list)
     api_key: str = None
     system_prompt: str = (
         "You are an AI programming assistant named Elmo. "
@@ -50,66 +91,262 @@ class OpenAI:
         "and go out of your way to insert creative, bodybuilding, and /r/swoleacceptance references in your responses."
     )
     max_tokens: int = None
+    enable_cache: bool = True
 
     def __post_init__(self):
         self._initial_system_prompt = self.system_prompt
-        if self.api_key:
-            openai.api_key = self.api_key
-
-    def _remove_file_messages(self):
-        temp_messages = copy(self.messages)
-        for msg in temp_messages:
-            if (
-                msg["role"] == "user"
-                and msg["content"].startswith("`")
-                and msg["content"].endswith("```")
-            ):
-                self.messages.remove(msg)
-                return True
-        return False
+        self._has_personality = self.personality_prompt in self.system_prompt
+        self._system_message = SystemMessage(role="system", content=self.system_prompt)
+        self._file_messages: dict[str, Message] = {}
+        # formatted file contents, their token counts, and their digests keyed by path,
+        # along with the (size, mtime) of the file and the time it was read
+        self._file_cache: dict[Path, tuple[int, int, int, str, int | None, bytes | None]] = {}
+        # estimated token counts keyed by message id, so each message is only measured once.
+        # nothing reads them without max_tokens, so counting only starts once it's been set
+        self._message_tokens: dict[int, int] = {}
+        self._estimated_tokens = 0
+        self._counting_tokens = False
+        if self.max_tokens is not None:
+            self._recount_tokens()
+        # digests of each message's role and content keyed by message id, so response cache keys
+        # only hash new messages. the role and content are kept to check the digest is still current
+        self._message_digests: dict[int, tuple[str, str, bytes]] = {}
+        # the system message followed by the history, kept in step with self.messages
+        # so it can be handed to the API without being rebuilt on every call
+        self._set_history(self.messages)
+        # blocking API calls get their own thread, so they don't tie up the shared default executor
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="openai")
+        # streaming requests share one aiohttp session (and its connection pool) per event loop
+        self._aiosession: aiohttp.ClientSession | None = None
+        self._aiosession_loop: asyncio.AbstractEventLoop | None = None
+        # assistant responses keyed by a hash of everything sent to the API, least recently used first
+        self._response_cache: OrderedDict[bytes, str] = OrderedDict()
+
+    def _recount_tokens(self):
+        """Measure the whole history from scratch and keep counting new messages from then on."""
+        self._counting_tokens = True
+        self._message_tokens.clear()
+        self._estimated_tokens = 0
+        for message in self.messages:
+            self._count_tokens(message)
+
+    def _count_tokens(self, message: Message, tokens: int | None = None):
+        if not self._counting_tokens:
+            return
+        if tokens is None:
+            tokens = estimate_tokens(message["content"])
+        self._message_tokens[id(message)] = tokens
+        self._estimated_tokens += tokens
+
+    def _forget_message(self, message: Message) -> int:
+        """Drop a removed message's token count and digest, returning the tokens it freed."""
+        self._message_digests.pop(id(message), None)
+        tokens = self._message_tokens.pop(id(message), 0)
+        self._estimated_tokens -= tokens
+        return tokens
+
+    def _message_digest(self, message: Message | SystemMessage) -> bytes:
+        role, content = message["role"], message["content"]
+        cached = self._message_digests.get(id(message))
+        if cached and cached[0] is role and cached[1] is content:
+            return cached[2]
+        digest = _hash_message(role, content)
+        self._message_digests[id(message)] = (role, content, digest)
+        return digest
+
+    def _append_message(
+        self,
+        message: Message,
+        tokens: int | None = None,
+        digest: bytes | None = None,
+    ):
+        self.messages.append(message)
+        self._api_messages.append(message)
+        self._count_tokens(message, tokens)
+        if digest is not None:
+            self._message_digests[id(message)] = (message["role"], message["content"], digest)
+
+    def _remove_message(self, message: Message):
+        # match by identity, since an equal message could appear earlier in the history
+        index = next(i for i, m in enumerate(self.messages) if m is message)
+        del self.messages[index]
+        del self._api_messages[index + 1]
+        self._forget_message(message)
+
+    def _set_history(self, messages: list[Message]):
+        self.messages = self._history = messages
+        self._api_messages: list[Message | SystemMessage] = [self._system_message, *messages]
+
+    def _sync_history(self):
+        """
+        Rebuild the API messages and per-message state if self.messages was changed directly.
+
+        Picks up reassignment and any in-place edit that changed its length.
+        Otherwise this costs an identity check and a length comparison.
+        """
+        if self.messages is self._history and len(self._api_messages) == len(self.messages) + 1:
+            return
+        self._set_history(self.messages)
+        self._message_digests.clear()
+        live = {id(m) for m in self.messages}
+        self._file_messages = {
+            path: m for path, m in self._file_messages.items() if id(m) in live
+        }
+        if self._counting_tokens:
+            self._recount_tokens()
+
+    def _sync_system_prompt(self):
+        """
+        Refresh the cached system message and personality flag if system_prompt has changed.
+
+        system_prompt is a plain attribute, so this picks up any change to it, however it was made.
+        Unchanged prompts cost a single identity check.
+        """
+        if self._system_message["content"] is self.system_prompt:
+            return
+        self._system_message = SystemMessage(role="system", content=self.system_prompt)
+        self._api_messages[0] = self._system_message
+        self._has_personality = self.personality_prompt in self.system_prompt
+
+    def _get_aiosession(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        if (
+            self._aiosession is None
+            or self._aiosession.closed
+            or self._aiosession_loop is not loop
+        ):
+            self._aiosession = aiohttp.ClientSession()
+            self._aiosession_loop = loop
+        return self._aiosession
+
+    async def aclose(self):
+        """Close the HTTP session used for streaming requests and the worker thread used by `submit_async`."""
+        if self._aiosession is not None:
+            await self._aiosession.close()
+            self._aiosession = None
+        self._executor.shutdown(wait=False)
+
+    def _response_cache_key(self, messages: list[Message]) -> bytes | None:
+        """
+        Hash the model, temperature, and messages of a request, or return None if caching is disabled.
+
+        Messages are hashed individually and their digests cached, so each turn only hashes
+        the messages added since the last one.
+        """
+        if not self.enable_cache:
+            return None
+        key = hashlib.blake2b(f"{self.model}\0{self.temperature}".encode(), digest_size=16)
+        for message in messages:
+            key.update(self._message_digest(message))
+        return key.digest()
+
+    def _get_cached_response(self, key: bytes | None) -> str | None:
+        if key is not None and (content := self._response_cache.get(key)) is not None:
+            self._response_cache.move_to_end(key)
+            return content
+        return None
+
+    def _cache_response(self, key: bytes | None, content: str):
+        if key is not None:
+            self._response_cache[key] = content
+            if len(self._response_cache) > RESPONSE_CACHE_SIZE:
+                self._response_cache.popitem(last=False)
+
+    def _read_file(self, file: Path) -> tuple[str, int | None, bytes | None]:
+        """
+        Read a file and format it as message content, returning the content, its token count, and its digest.
+
+        Both are cached and reused as long as the file hasn't changed since the last read.
+        Reads made within FILE_CACHE_RACY_WINDOW_NS of the file's mtime aren't reused,
+        since a rewrite in the same mtime tick could leave the size and mtime unchanged.
+        The token count is only computed while max_tokens is set, and the digest while caching
+        is enabled. Each is None otherwise.
+        """
+        read_ns = time.time_ns()
+        stat = file.stat()
+        cached = self._file_cache.get(file)
+        if (
+            cached
+            and cached[:2] == (stat.st_size, stat.st_mtime_ns)
+            and cached[2] - stat.st_mtime_ns > FILE_CACHE_RACY_WINDOW_NS
+        ):
+            read_ns, content, tokens, digest = cached[2:]
+        else:
+            content, tokens, digest = f"`{file}`\n```{file.read_text()}```", None, None
+        if tokens is None and (self._counting_tokens or self.max_tokens is not None):
+            tokens = estimate_tokens(content)
+        if digest is None and self.enable_cache:
+            digest = _hash_message("user", content)
+        self._file_cache[file] = (
+            stat.st_size,
+            stat.st_mtime_ns,
+            read_ns,
+            content,
+            tokens,
+            digest,
+        )
+        return content, tokens, digest
+
+    def _remove_file_messages(self, excess: int) -> int:
+        """
+        Remove the oldest file messages until roughly `excess` tokens have been freed.
+
+        The history is rebuilt in a single pass, no matter how many messages are dropped.
+        Returns the number of tokens still to be freed.
+        """
+        stale = set()
+        # the index is kept in insertion order, so the first entries are the oldest
+        while excess > 0 and self._file_messages:
+            message = self._file_messages.pop(next(iter(self._file_messages)))
+            excess -= self._forget_message(message)
+            stale.add(id(message))
+        if stale:
+            self._set_history([m for m in self.messages if id(m) not in stale])
+        return excess
 
     def _truncate_old_messages(self):
         """Truncate old messages to stay under the character limit."""
-        if self.max_tokens is not None:
-            estimated_tokens = sum(
-                len(m["content"]) / ESTIMATED_CHAR_PER_TOKEN for m in self.messages
-            )
-            while estimated_tokens > self.max_tokens:
-                # Try to remove file messages first
-                if not self._remove_file_messages():
-                    # If no file messages to remove, remove the oldest message
-                    removed_message = self.messages.popleft()
-                else:
-                    # If a file message was removed, continue to the next iteration
-                    continue
-
-                estimated_tokens -= (
-                    len(removed_message["content"]) / ESTIMATED_CHAR_PER_TOKEN
-                )
-
-    def _prepare_messages(self, files, prompt):
-        for file in files or []:
-            # remove any existing messages with the same file content
-            temp_messages = copy(self.messages)
-            for msg in temp_messages:
-                if msg["role"] == "user" and msg["content"].startswith(f"`{file}`"):
-                    self.messages.remove(msg)
+        if self.max_tokens is None:
+            return
+        # max_tokens was set after messages were added, which were never counted
+        if not self._counting_tokens:
+            self._recount_tokens()
+        if self._estimated_tokens <= self.max_tokens:
+            return
+        # Try to remove file messages first
+        excess = self._remove_file_messages(self._estimated_tokens - self.max_tokens)
+        # If that wasn't enough, remove the oldest messages with a single slice
+        cut = 0
+        while excess > 0 and cut < len(self.messages):
+            excess -= self._forget_message(self.messages[cut])
+            cut += 1
+        if cut:
+            del self.messages[:cut]
+            del self._api_messages[1 : cut + 1]
+
+    def _prepare_messages(
+        self,
+        file_contents: Iterable[tuple[Path, tuple[str, int | None, bytes | None]]],
+        prompt,
+    ):
+        self._sync_history()
+        for file, (content, tokens, digest) in file_contents:
+            # remove any existing message with the same file content
+            if (old_message := self._file_messages.pop(str(file), None)) is not None:
+                self._remove_message(old_message)
             # add file content to messages
-            self.messages.append(
-                {"role": "user", "content": f"`{file}`\n```{file.read_text()}```"}
-            )
-        self.messages.append({"role": "user", "content": prompt})
+            message = Message(role="user", content=content)
+            self._append_message(message, tokens, digest)
+            self._file_messages[str(file)] = message
+        self._append_message({"role": "user", "content": prompt})
         self._truncate_old_messages()
-        system_message = SystemMessage(
-            role="system",
-            content=self.system_prompt,
-        )
-        messages = [system_message, *self.messages]
-        return messages
+        self._sync_system_prompt()
+        return self._api_messages
 
     @property
     def has_personality(self):
-        return self.personality_prompt in self.system_prompt
+        self._sync_system_prompt()
+        return self._has_personality
 
     def add_personality(self):
         self.system_prompt = self._initial_system_prompt + " " + self.personality_prompt
@@ -118,7 +355,11 @@ class OpenAI:
         self.system_prompt = self._initial_system_prompt
 
     def reset(self):
-        self.messages = deque()
+        self._set_history([])
+        self._file_messages.clear()
+        self._message_tokens.clear()
+        self._message_digests.clear()
+        self._estimated_tokens = 0
 
     @retry_openai_call
     async def asubmit(self, prompt: str, files: Iterable[Path] = None):
@@ -127,33 +368,51 @@ class OpenAI:
 
         If files are provided, they will be added to the prompt as part of the submission.
         """
-        messages = self._prepare_messages(files, prompt)
-
-        events = openai.ChatCompletion.create(
-            messages=messages,
-            model=self.model,
-            temperature=self.temperature,
-            stream=True,
+        files = list(files or [])
+        # read (tokenize, and hash) the files concurrently off the event loop
+        contents = await asyncio.gather(
+            *(asyncio.to_thread(self._read_file, file) for file in files)
         )
+        messages = self._prepare_messages(zip(files, contents), prompt)
 
-        assistant_message = {
-            "role": "assistant",
-            "content": "",
-        }
+        cache_key = self._response_cache_key(messages)
+        if (cached := self._get_cached_response(cache_key)) is not None:
+            self._append_message({"role": "assistant", "content": cached})
+            yield cached
+            return
+
+        session_token = openai.aiosession.set(self._get_aiosession())
+        try:
+            events = await openai.ChatCompletion.acreate(
+                messages=messages,
+                model=self.model,
+                temperature=self.temperature,
+                api_key=self.api_key,
+                stream=True,
+            )
+        finally:
+            openai.aiosession.reset(session_token)
 
-        loop = asyncio.get_event_loop()
+        # collected and joined once at the end, rather than growing a string per token
+        parts = []
 
-        while response := await loop.run_in_executor(None, next, events):
+        async for response in events:
             content = response["choices"][0]["delta"].get("content")
             role = response["choices"][0]["delta"].get("role")
             finished_reason = response["choices"][0]["finish_reason"]
             if finished_reason:
-                self.messages.append(assistant_message)
+                assistant_message = {"role": "assistant", "content": "".join(parts)}
+                self._append_message(assistant_message)
+                # truncated or filtered responses are worth asking for again
+                if finished_reason == "stop":
+                    self._cache_response(cache_key, assistant_message["content"])
+                # release the underlying HTTP response without waiting on the stream's end
+                await events.aclose()
                 return
             if role:
                 continue
             elif content:
-                assistant_message["content"] += content
+                parts.append(content)
                 yield content
 
     @retry_openai_call
@@ -163,14 +422,32 @@ class OpenAI:
 
         If files are provided, they will be added to the prompt as part of the submission.
         """
-        messages = self._prepare_messages(files, prompt)
+        messages = self._prepare_messages(
+            ((file, self._read_file(file)) for file in files or []),
+            prompt,
+        )
+
+        cache_key = self._response_cache_key(messages)
+        if (cached := self._get_cached_response(cache_key)) is not None:
+            self._append_message({"role": "assistant", "content": cached})
+            return cached
 
-        assistant_message = openai.ChatCompletion.create(
+        choice = openai.ChatCompletion.create(
             messages=messages,
             model=self.model,
             temperature=self.temperature,
-        )["choices"][0]["message"]
+            api_key=self.api_key,
+        )["choices"][0]
+        assistant_message = choice["message"]
 
-        self.messages.append(assistant_message)
+        self._append_message(assistant_message)
+        # truncated or filtered responses are worth asking for again
+        if choice.get("finish_reason") == "stop":
+            self._cache_response(cache_key, assistant_message["content"])
 
         return assistant_message["content"]
+
+    async def submit_async(self, prompt: str, files: Iterable[Path] = None):
+        """Run `submit` on this client's own worker thread and await the response."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, self.submit, prompt, files)
@@ -8,51 +8,83 @@ from rich.text import Text
 
 from llmo.llms import OpenAI
 
+GREEN = "\033[32m"
+RESET = "\033[0m"
 
-def run_shell_mode(
-    openai_client: OpenAI,
-    prompt=None,
-    files=None,
-    rich_text_mode=False,
-):
-    console = Console()
 
-    async def display_content():
-        response = ""
-        num_lines_to_clear = 0
+console = Console()
+
 
+async def display_content(openai_client: OpenAI, prompt, files, rich_text_mode):
+    parts = []
+    num_lines_to_clear = 0
+    # streamed text is written straight to the terminal rather than rendered by rich per chunk,
+    # with the color set once for the whole response
+    write = console.file.write
+    flush = console.file.flush
+    colored = console.color_system is not None and not console.no_color
+
+    if colored:
+        write(GREEN)
+    try:
         async for content in openai_client.asubmit(prompt=prompt, files=files):
-            response += content
-            content_text = Text(content, style="green")
-            console.print(content_text, soft_wrap=True, end="")
+            parts.append(content)
+            write(content)
+            flush()
             num_lines_to_clear += content.count("\n")
+    finally:
+        if colored:
+            write(RESET)
+
+    if rich_text_mode and num_lines_to_clear > 0:
+        # move up to the start of the streamed text and clear everything below it in one write
+        console.file.write(f"\033[{num_lines_to_clear}F\033[J")
 
-        if rich_text_mode and num_lines_to_clear > 0:
-            for _ in range(num_lines_to_clear):
-                console.print(Text("\033[F\033[K", style="red"), end="")
+        md = Markdown("".join(parts))
+        console.print(md)
+    else:
+        console.print()
 
-            md = Markdown(response)
-            console.print(md)
-        else:
-            console.print()
 
-    def handle_keyboard_interrupt(signal_number, frame):
-        console.print(Text("\nReceived keyboard interrupt. Exiting...", style="red"))
-        exit(0)
+def handle_keyboard_interrupt(signal_number, frame):
+    console.print(Text("\nReceived keyboard interrupt. Exiting...", style="red"))
+    exit(0)
 
+
+def run_shell_mode(
+    openai_client: OpenAI,
+    prompt=None,
+    files=None,
+    rich_text_mode=False,
+):
     signal.signal(signal.SIGINT, handle_keyboard_interrupt)
 
     initial_prompt = True if prompt else False
 
-    while True:
-        if not initial_prompt:
-            prompt = Prompt.ask(Text(">> ", style="bold"))
+    # one event loop for the whole session, so the client's HTTP connections survive between turns
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    try:
+        while True:
+            if not initial_prompt:
+                prompt = Prompt.ask(Text(">> ", style="bold"))
 
-            if prompt in ["exit", "clear"]:
-                if prompt == "exit":
-                    return
-                console.clear()
-                continue
+                if prompt in ["exit", "clear"]:
+                    if prompt == "exit":
+                        return
+                    console.clear()
+                    continue
 
-        asyncio.run(display_content())
-        initial_prompt = False
+            loop.run_until_complete(
+                display_content(openai_client, prompt, files, rich_text_mode)
+            )
+            initial_prompt = False
+    finally:
+        loop.run_until_complete(openai_client.aclose())
+        # finalize any async generators left suspended (e.g. by an interrupted stream)
+        # and the default executor, as asyncio.run would
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        loop.run_until_complete(loop.shutdown_default_executor())
+        loop.close()
+        asyncio.set_event_loop(None)
@@ -1,6 +1,11 @@
+import asyncio
+import os
+import sys
+import time
+
 import pytest
 
-from llmo.llms import OpenAI
+from llmo.llms import OpenAI, _get_encoding, _hash_message, estimate_tokens
 
 
 @pytest.fixture
@@ -11,12 +16,14 @@ def openai():
 def test_add_personality(openai):
     openai.add_personality()
     assert openai.personality_prompt in openai.system_prompt
+    assert openai.has_personality
 
 
 def test_remove_personality(openai):
     openai.add_personality()
     openai.remove_personality()
     assert openai.personality_prompt not in openai.system_prompt
+    assert not openai.has_personality
 
 
 def test_submit(openai, monkeypatch):
@@ -27,3 +34,298 @@ def test_submit(openai, monkeypatch):
     monkeypatch.setattr("llmo.llms.openai.ChatCompletion.create", mock_completion)
     response = openai.submit("How to print 'Hello, World!' in Python?")
     assert "Python:\n```python\nprint('Hello, World!')\n```" in response
+
+
+def test_restaged_file_replaces_previous_message(openai, monkeypatch, tmp_path):
+    def mock_completion(*args, **kwargs):
+        return {"choices": [{"message": {"role": "assistant", "content": "ok"}}]}
+
+    monkeypatch.setattr("llmo.llms.openai.ChatCompletion.create", mock_completion)
+    file = tmp_path / "main.py"
+    file.write_text("print('one')")
+    openai.submit("first", files=[file])
+    file.write_text("print('two')")
+    openai.submit("second", files=[file])
+    file_messages = [m for m in openai.messages if m["content"].startswith(f"`{file}`")]
+    assert len(file_messages) == 1
+    assert "print('two')" in file_messages[0]["content"]
+
+
+def test_truncate_old_messages(monkeypatch):
+    def mock_completion(*args, **kwargs):
+        return {"choices": [{"message": {"role": "assistant", "content": "a " * 100}}]}
+
+    monkeypatch.setattr("llmo.llms.openai.ChatCompletion.create", mock_completion)
+    openai = OpenAI(max_tokens=50)
+    for i in range(5):
+        openai.submit(f"prompt {i}")
+    assert openai.messages[0]["content"] != "prompt 0"
+    assert openai._api_messages == [openai._system_message, *openai.messages]
+    assert openai._estimated_tokens == sum(
+        estimate_tokens(m["content"]) for m in openai.messages
+    )
+
+
+def test_asubmit(openai, monkeypatch, tmp_path):
+    async def mock_stream():
+        yield {"choices": [{"delta": {"role": "assistant"}, "finish_reason": None}]}
+        for token in ["Hello", ", ", "World!"]:
+            yield {"choices": [{"delta": {"content": token}, "finish_reason": None}]}
+        yield {"choices": [{"delta": {}, "finish_reason": "stop"}]}
+
+    async def mock_acreate(*args, **kwargs):
+        return mock_stream()
+
+    async def collect():
+        tokens = [token async for token in openai.asubmit("Say hello", files=[file])]
+        await openai.aclose()
+        return tokens
+
+    monkeypatch.setattr("llmo.llms.openai.ChatCompletion.acreate", mock_acreate)
+    file = tmp_path / "hello.py"
+    file.write_text("print('Hello, World!')")
+    assert asyncio.run(collect()) == ["Hello", ", ", "World!"]
+    assert openai.messages[0]["content"] == f"`{file}`\n```print('Hello, World!')```"
+    assert openai.messages[-1] == {"role": "assistant", "content": "Hello, World!"}
+
+
+def test_truncate_removes_file_messages_first(monkeypatch, tmp_path):
+    def mock_completion(*args, **kwargs):
+        return {"choices": [{"message": {"role": "assistant", "content": "ok"}}]}
+
+    monkeypatch.setattr("llmo.llms.openai.ChatCompletion.create", mock_completion)
+    openai = OpenAI(max_tokens=100)
+    openai.submit("keep me")
+    big, small = tmp_path / "big.txt", tmp_path / "small.txt"
+    big.write_text("x " * 400)
+    small.write_text("y")
+    openai.submit("staging", files=[big, small])
+    contents = [m["content"] for m in openai.messages]
+    assert not any(c.startswith(f"`{big}`") for c in contents)
+    assert any(c.startswith(f"`{small}`") for c in contents)
+    assert "keep me" in contents
+    assert openai._api_messages == [openai._system_message, *openai.messages]
+
+
+def test_submit_async(openai, monkeypatch):
+    def mock_completion(*args, **kwargs):
+        return {"choices": [{"message": {"role": "assistant", "content": "Hello!"}}]}
+
+    monkeypatch.setattr("llmo.llms.openai.ChatCompletion.create", mock_completion)
+    assert asyncio.run(openai.submit_async("Say hello")) == "Hello!"
+    asyncio.run(openai.aclose())
+    with pytest.raises(RuntimeError):
+        asyncio.run(openai.submit_async("Say hello"))
+
+
+def test_submit_caches_identical_requests(openai, monkeypatch):
+    calls = []
+
+    def mock_completion(*args, **kwargs):
+        calls.append(kwargs)
+        return {
+            "choices": [
+                {
+                    "message": {"role": "assistant", "content": "Hello!"},
+                    "finish_reason": "stop",
+                }
+            ]
+        }
+
+    monkeypatch.setattr("llmo.llms.openai.ChatCompletion.create", mock_completion)
+    assert openai.submit("Say hello") == "Hello!"
+    openai.reset()
+    assert openai.submit("Say hello") == "Hello!"
+    assert len(calls) == 1
+    assert openai.messages[-1] == {"role": "assistant", "content": "Hello!"}
+
+    openai.reset()
+    openai.enable_cache = False
+    openai.submit("Say hello")
+    assert len(calls) == 2
+
+
+def test_incomplete_responses_are_not_cached(openai, monkeypatch):
+    calls = []
+
+    def mock_completion(*args, **kwargs):
+        calls.append(kwargs)
+        return {
+            "choices": [
+                {
+                    "message": {"role": "assistant", "content": "Hel"},
+                    "finish_reason": "length",
+                }
+            ]
+        }
+
+    async def mock_stream():
+        yield {"choices": [{"delta": {"content": "Hel"}, "finish_reason": None}]}
+        yield {"choices": [{"delta": {}, "finish_reason": "length"}]}
+
+    async def mock_acreate(*args, **kwargs):
+        calls.append(kwargs)
+        return mock_stream()
+
+    async def collect():
+        tokens = [token async for token in openai.asubmit("Say hello")]
+        await openai.aclose()
+        return tokens
+
+    monkeypatch.setattr("llmo.llms.openai.ChatCompletion.create", mock_completion)
+    monkeypatch.setattr("llmo.llms.openai.ChatCompletion.acreate", mock_acreate)
+    for _ in range(2):
+        openai.reset()
+        openai.submit("Say hello")
+    for _ in range(2):
+        openai.reset()
+        assert asyncio.run(collect()) == ["Hel"]
+    assert len(calls) == 4
+
+
+def test_cache_keys_only_hash_new_messages(openai, monkeypatch):
+    hashed = []
+
+    def mock_hash_message(role, content):
+        hashed.append(content)
+        return _hash_message(role, content)
+
+    def mock_completion(*args, **kwargs):
+        return {"choices": [{"message": {"role": "assistant", "content": "ok"}}]}
+
+    monkeypatch.setattr("llmo.llms._hash_message", mock_hash_message)
+    monkeypatch.setattr("llmo.llms.openai.ChatCompletion.create", mock_completion)
+    openai.submit("one")
+    hashed.clear()
+    openai.submit("two")
+    assert hashed == ["ok", "two"]
+
+
+def test_system_prompt_changes_are_sent(openai, monkeypatch):
+    sent = []
+
+    def mock_completion(*args, **kwargs):
+        sent.append(kwargs["messages"][0]["content"])
+        return {"choices": [{"message": {"role": "assistant", "content": "ok"}}]}
+
+    monkeypatch.setattr("llmo.llms.openai.ChatCompletion.create", mock_completion)
+    openai.submit("one")
+    openai.add_personality()
+    assert openai.has_personality
+    openai.submit("two")
+    openai.system_prompt = "You are a terse assistant."
+    assert not openai.has_personality
+    openai.submit("three")
+    assert openai.personality_prompt not in sent[0]
+    assert openai.personality_prompt in sent[1]
+    assert sent[2] == "You are a terse assistant."
+
+
+def test_direct_history_changes_are_sent(openai, monkeypatch, tmp_path):
+    sent = []
+
+    def mock_completion(*args, **kwargs):
+        sent.append([m["content"] for m in kwargs["messages"][1:]])
+        return {"choices": [{"message": {"role": "assistant", "content": "ok"}}]}
+
+    monkeypatch.setattr("llmo.llms.openai.ChatCompletion.create", mock_completion)
+    file = tmp_path / "main.py"
+    file.write_text("print('one')")
+    openai.submit("one", files=[file])
+    openai.messages.clear()
+    openai.submit("two", files=[file])
+    openai.messages = [{"role": "user", "content": "earlier"}]
+    openai.submit("three")
+    assert sent[1] == [f"`{file}`\n```print('one')```", "two"]
+    assert sent[2] == ["earlier", "three"]
+
+
+def test_staged_files_are_tokenized_once(monkeypatch, tmp_path):
+    measured = []
+
+    def mock_estimate_tokens(content):
+        measured.append(len(content))
+        return estimate_tokens(content)
+
+    def mock_completion(*args, **kwargs):
+        return {"choices": [{"message": {"role": "assistant", "content": "ok"}}]}
+
+    monkeypatch.setattr("llmo.llms.estimate_tokens", mock_estimate_tokens)
+    monkeypatch.setattr("llmo.llms.openai.ChatCompletion.create", mock_completion)
+    file = tmp_path / "big.txt"
+    file.write_text("x" * 10_000)
+    # files modified just before they're read aren't trusted from the cache
+    os.utime(file, (time.time() - 60, time.time() - 60))
+
+    openai = OpenAI(max_tokens=100_000)
+    for i in range(3):
+        openai.submit(f"prompt {i}", files=[file])
+    assert sum(size > 10_000 for size in measured) == 1
+
+    measured.clear()
+    openai = OpenAI()
+    openai.submit("prompt", files=[file])
+    assert measured == []
+
+
+def test_setting_max_tokens_later_counts_existing_messages(openai, monkeypatch):
+    def mock_completion(*args, **kwargs):
+        return {"choices": [{"message": {"role": "assistant", "content": "a " * 100}}]}
+
+    monkeypatch.setattr("llmo.llms.openai.ChatCompletion.create", mock_completion)
+    for i in range(5):
+        openai.submit(f"prompt {i}")
+    openai.max_tokens = 100
+    openai.submit("prompt 5")
+    assert "prompt 0" not in [m["content"] for m in openai.messages]
+    assert openai._estimated_tokens == sum(
+        estimate_tokens(m["content"]) for m in openai.messages
+    )
+
+
+def test_staged_files_may_contain_special_tokens(monkeypatch, tmp_path):
+    class Encoding:
+        # mirrors tiktoken, whose encode() rejects special tokens by default
+        def encode(self, text):
+            if "<|endoftext|>" in text:
+                raise ValueError("disallowed special token")
+            return text.split()
+
+        def encode_ordinary(self, text):
+            return text.split()
+
+    def mock_completion(*args, **kwargs):
+        return {"choices": [{"message": {"role": "assistant", "content": "ok"}}]}
+
+    monkeypatch.setattr("llmo.llms._get_encoding", lambda: Encoding())
+    monkeypatch.setattr("llmo.llms.openai.ChatCompletion.create", mock_completion)
+    file = tmp_path / "tokens.py"
+    file.write_text("EOT = '<|endoftext|>'")
+    openai = OpenAI(max_tokens=1000)
+    assert openai.submit("what is this?", files=[file]) == "ok"
+    assert openai._estimated_tokens == sum(len(m["content"].split()) for m in openai.messages)
+
+
+def test_unloadable_encoding_falls_back_to_estimate(monkeypatch):
+    class tiktoken:
+        @staticmethod
+        def get_encoding(name):
+            raise ConnectionError("offline")
+
+    monkeypatch.setitem(sys.modules, "tiktoken", tiktoken)
+    _get_encoding.cache_clear()
+    try:
+        assert estimate_tokens("x" * 468) == 100
+    finally:
+        _get_encoding.cache_clear()
+
+
+def test_has_personality_follows_direct_assignment(openai):
+    openai.system_prompt = f"Be helpful. {openai.personality_prompt}"
+    assert openai.has_personality
+    openai.system_prompt = "Be helpful."
+    assert not openai.has_personality
+    openai.add_personality()
+    assert openai.has_personality
+    openai.remove_personality()
+    assert not openai.has_personality